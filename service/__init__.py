@@ -22,6 +22,7 @@ import sys
 from flask import Flask
 from service import config
 from service.common import log_handlers
+from service.common.cart_cache import cart_cache
 
 
 ############################################################
@@ -38,6 +39,7 @@ def create_app():
     from service.models import db
 
     db.init_app(app)
+    cart_cache.init_app(app)
 
     with app.app_context():
         # Dependencies require we import the routes AFTER the Flask app is created
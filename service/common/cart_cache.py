@@ -0,0 +1,119 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Cart Cache
+
+This module contains a bounded LRU cache of serialized Shopcarts with a
+time to live. Each worker process has its own cache, so a write made by
+another worker is only seen here once the entry expires.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class CartCache:
+    """A thread safe LRU cache of serialized Shopcarts keyed by customer ID"""
+
+    def __init__(self, max_size: int = 0, ttl: float = 30.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        """Configures the cache from the CART_CACHE_* settings of the app"""
+        self.max_size = app.config.get("CART_CACHE_SIZE", 0)
+        self.ttl = app.config.get("CART_CACHE_TTL", 30.0)
+        self.clear()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        """True when the cache is allowed to hold any entries"""
+        return self.max_size > 0
+
+    def generation(self) -> int:
+        """
+        Returns a token to pass to set()
+
+        Take it before reading from the database: if a write invalidates
+        the cache in the meantime, set() drops the now stale value.
+        """
+        return self._generation
+
+    def get(self, key):
+        """Returns the cached value for key, or None when missing or expired"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, generation: int) -> None:
+        """Caches value for key unless the cache was invalidated since generation"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key) -> None:
+        """Removes the cached value for key"""
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        """Removes every cached value"""
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """Returns the size and hit rate of the cache"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "miss_rate": self.misses / lookups if lookups else 0.0,
+            }
+
+
+# The cache of this worker, configured later in create_app()
+cart_cache = CartCache()
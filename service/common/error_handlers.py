@@ -19,7 +19,7 @@ Module: error_handlers
 from flask import jsonify
 from flask import current_app as app  # Import Flask application
 
-from service.models import DataValidationError
+from service.models import DataValidationError, PreconditionFailedError
 from . import status
 
 
@@ -32,6 +32,21 @@ def request_validation_error(error):
     return bad_request(error)
 
 
+@app.errorhandler(PreconditionFailedError)
+def precondition_failed(error):
+    """Handles stale ETags with 412_PRECONDITION_FAILED"""
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        jsonify(
+            status=status.HTTP_412_PRECONDITION_FAILED,
+            error="Precondition Failed",
+            message=message,
+        ),
+        status.HTTP_412_PRECONDITION_FAILED,
+    )
+
+
 @app.errorhandler(status.HTTP_400_BAD_REQUEST)
 def bad_request(error):
     """Handles bad requests with 400_BAD_REQUEST"""
@@ -15,6 +15,21 @@ SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 # SQLALCHEMY_POOL_SIZE = 2
 
+# Where Shopcart items are stored: "jsonb" keeps them in the item_list
+# column, "table" keeps one row per item in the shopcart_items table
+ITEM_STORAGE = os.getenv("ITEM_STORAGE", "jsonb")
+
+# Number of Shopcarts returned per page by GET /api/shopcarts
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", "100"))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "1000"))
+
+# Number of Shopcarts fetched per round trip when streaming NDJSON
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", "500"))
+
+# Per worker cache of serialized Shopcarts, disabled when the size is 0
+CART_CACHE_SIZE = int(os.getenv("CART_CACHE_SIZE", "0"))
+CART_CACHE_TTL = float(os.getenv("CART_CACHE_TTL", "30"))
+
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "sup3r-s3cr3t")
 LOGGING_LEVEL = logging.INFO
@@ -4,12 +4,16 @@ Models for Shopcart
 All of the models are stored in this module
 """
 
+import json
 import logging
+import re
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy import and_, func, literal, select, text
+from sqlalchemy.dialects.postgresql import JSONB, insert
 from sqlalchemy.ext.mutable import MutableList
-from sqlalchemy.orm import validates
-from sqlalchemy.orm.attributes import flag_modified
+from sqlalchemy.orm import selectinload
+from service.common.cart_cache import cart_cache
 
 logger = logging.getLogger("flask.app")
 
@@ -21,6 +25,112 @@ class DataValidationError(Exception):
     """Used for an data validation errors when deserializing"""
 
 
+class PreconditionFailedError(Exception):
+    """Used when a Shopcart no longer has the ETag a request expected"""
+
+
+# Returns the items of a cart matching a JSON path, or no row when the cart
+# does not exist. The cart is located through the unique customer_id index
+# and only the matching items are sent back to the service.
+FILTER_ITEMS_SQL = text(
+    """
+    SELECT jsonb_path_query_array(item_list, CAST(:path AS jsonpath), CAST(:vars AS jsonb))
+    FROM shopcart
+    WHERE customer_id = :customer_id
+    """
+)
+
+
+# Adds an item to the item_list of a cart, or increments its quantity when
+# the product is already there, and returns the resulting item. The row lock
+# taken by the UPDATE serializes concurrent adds to the same cart.
+UPSERT_ITEM_SQL = text(
+    """
+    UPDATE shopcart
+    SET version = version + 1,
+    item_list = CASE
+        WHEN item_list @> jsonb_build_array(jsonb_build_object('product_id', :product_id))
+        THEN (
+            SELECT jsonb_agg(
+                CASE WHEN elem @> jsonb_build_object('product_id', :product_id)
+                THEN jsonb_set(elem, '{quantity}', to_jsonb((elem->>'quantity')::integer + :quantity))
+                ELSE elem END
+                ORDER BY position
+            )
+            FROM jsonb_array_elements(item_list) WITH ORDINALITY AS t(elem, position)
+        )
+        ELSE coalesce(item_list, '[]'::jsonb) || jsonb_build_array(CAST(:item AS jsonb))
+    END
+    WHERE customer_id = :customer_id
+    RETURNING (
+        SELECT elem FROM jsonb_array_elements(item_list) AS t(elem)
+        WHERE elem @> jsonb_build_object('product_id', :product_id)
+        LIMIT 1
+    )
+    """
+)
+
+
+def make_etag(shopcart_id, version):
+    """Returns the ETag of a Shopcart from its id and version"""
+    # The id tells apart a cart that was deleted and created again
+    return f"{shopcart_id}-{version}"
+
+
+def item_table_enabled():
+    """Returns True when items are stored in the shopcart_items table"""
+    return current_app.config.get("ITEM_STORAGE", "jsonb") == "table"
+
+
+class ShopcartItem(db.Model):
+    """
+    Class that represents an item row of a Shopcart
+
+    Only used when ITEM_STORAGE is "table", in which case the items of a
+    cart live here instead of in the Shopcart.item_list JSONB column.
+    """
+
+    __tablename__ = "shopcart_items"
+    __table_args__ = (
+        db.Index("ix_shopcart_items_position", "shopcart_id", "position"),
+    )
+
+    ##################################################
+    # Table Schema
+    ##################################################
+    shopcart_id = db.Column(
+        db.Integer,
+        db.ForeignKey("shopcart.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    product_id = db.Column(db.Integer, primary_key=True)
+    description = db.Column(db.String, nullable=False)
+    price = db.Column(db.Integer, nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    position = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<ShopcartItem {self.product_id} shopcart_id=[{self.shopcart_id}]>"
+
+    def serialize(self):
+        """Serializes a ShopcartItem into the same dictionary kept in item_list"""
+        return {
+            "product_id": self.product_id,
+            "description": self.description,
+            "price": self.price,
+            "quantity": self.quantity,
+        }
+
+    @classmethod
+    def next_position(cls, shopcart_id):
+        """Returns a SQL expression for the position after the last item of a cart"""
+        return (
+            select(func.coalesce(func.max(cls.position), -1) + 1)
+            .where(cls.shopcart_id == shopcart_id)
+            .scalar_subquery()
+        )
+
+
 class Shopcart(db.Model):
     """
     Class that represents a Shopcart
@@ -31,9 +141,48 @@ class Shopcart(db.Model):
     ##################################################
     id = db.Column(db.Integer, primary_key=True)
     customer_id = db.Column(db.Integer, unique=True)
-    item_list = db.Column(MutableList.as_mutable(JSONB), default=list)
+    version = db.Column(db.Integer, nullable=False, default=1)
+    _item_list = db.Column("item_list", MutableList.as_mutable(JSONB), default=list)
+    items = db.relationship(
+        ShopcartItem,
+        order_by=ShopcartItem.position,
+        cascade="all, delete-orphan",
+        passive_deletes=True,
+    )
+
+    @property
+    def item_list(self):
+        """The items of the Shopcart, read from the configured ITEM_STORAGE"""
+        if item_table_enabled():
+            return [item.serialize() for item in self.items]
+        return self._item_list
+
+    @item_list.setter
+    def item_list(self, value):
+        value = self.validate_item_list("item_list", value)
+        if not item_table_enabled():
+            self._item_list = value
+            return
+        # Reuse the rows of products already in the cart so that the
+        # flush issues UPDATEs instead of conflicting DELETE/INSERT pairs
+        existing = {item.product_id: item for item in self.items}
+        items = []
+        for position, data in enumerate(value):
+            item = existing.get(data["product_id"]) or ShopcartItem(
+                product_id=data["product_id"]
+            )
+            item.description = data["description"]
+            item.price = data["price"]
+            item.quantity = data["quantity"]
+            item.position = position
+            items.append(item)
+        self.items = items
+
+    @property
+    def etag(self):
+        """The ETag of the Shopcart, which changes whenever the Shopcart does"""
+        return make_etag(self.id, self.version)
 
-    @validates("item_list")
     def validate_item_list(self, key, value):
         """
         Validates sub-fields of item_list JSONB Array
@@ -75,6 +224,7 @@ class Shopcart(db.Model):
             self.customer_id = 33
         logger.info("Creating shopcart for %d", self.customer_id)
         self.id = None  # pylint: disable=invalid-name
+        customer_id = self.customer_id
         try:
             db.session.add(self)
             db.session.commit()
@@ -82,10 +232,15 @@ class Shopcart(db.Model):
             db.session.rollback()
             logger.error("Error creating record: %s", self)
             raise DataValidationError(e) from e
+        finally:
+            cart_cache.invalidate(customer_id)
 
     def create_subordinate(self, customer_id, data):
         """
         Creates an item to the Shopcart item_list
+
+        The item is added, or its quantity incremented when the product is
+        already in the cart, by one atomic statement. Returns the resulting item.
         """
         try:
             logger.info(
@@ -93,61 +248,94 @@ class Shopcart(db.Model):
                 data["product_id"],
                 customer_id,
             )
-            create_existing = False
-            cart = self.find(customer_id)
-            for item in cart.item_list:
-                if item["product_id"] == data["product_id"]:
-                    item["quantity"] += data["quantity"]
-                    data["quantity"] = item["quantity"]
-                    create_existing = True
-                    flag_modified(cart, "item_list")
-            if not create_existing:
-                cart.item_list.append(data)
+            self.validate_item_list("item_list", [data])
+            if item_table_enabled():
+                row = db.session.execute(self._upsert_item_row(customer_id, data)).first()
+                item = row._asdict() if row else None
+            else:
+                item = db.session.execute(
+                    UPSERT_ITEM_SQL,
+                    {
+                        "customer_id": customer_id,
+                        "product_id": data["product_id"],
+                        "quantity": data["quantity"],
+                        "item": json.dumps(data),
+                    },
+                ).scalar()
+            if item is None:
+                raise DataValidationError(
+                    f"Shopcart for customer '{customer_id}' was not found."
+                )
             db.session.commit()
+            return item
         except Exception as e:
             db.session.rollback()
             logger.error(
                 "Error creating record for customer %d : %s", customer_id, data
             )
             raise DataValidationError(e) from e
+        finally:
+            cart_cache.invalidate(customer_id)
 
-    def update(self, customer_id, data):
+    def update(self, customer_id, data, if_match=None):
         """
         Updates a Shopcart of a customer in the database
+
+        When if_match is given the update only happens if the ETag of the
+        Shopcart is in it, otherwise a PreconditionFailedError is raised.
         """
         logger.info("Updating shopcart for %d", customer_id)
         try:
-            cart = self.find(customer_id)
+            cart = self._find_for_update(customer_id, if_match)
             cart.item_list = data
+            cart.version = Shopcart.version + 1
             db.session.commit()
+        except PreconditionFailedError:
+            db.session.rollback()
+            raise
         except Exception as e:
             db.session.rollback()
             logger.error("Error updating record: %s", self)
             raise DataValidationError(e) from e
+        finally:
+            cart_cache.invalidate(customer_id)
 
-    def update_subordinate(self, customer_id, data):
+    def update_subordinate(self, customer_id, data, if_match=None):
         """
         Updates a Shopcart item of a customer in the database
+
+        When if_match is given the update only happens if the ETag of the
+        Shopcart is in it, otherwise a PreconditionFailedError is raised.
         """
         logger.info("Updating shopcart item %d for %d", data["product_id"], customer_id)
         try:
-            cart = self.find(customer_id)
-            newlist = []
-            for item in cart.item_list:
-                if item["product_id"] == data["product_id"]:
-                    newlist.append(data)
-                else:
-                    newlist.append(item)
-            cart.item_list = newlist
+            cart = self._find_for_update(customer_id, if_match)
+            if item_table_enabled():
+                self._update_item_row(cart, data)
+            else:
+                newlist = []
+                for item in cart.item_list:
+                    if item["product_id"] == data["product_id"]:
+                        newlist.append(data)
+                    else:
+                        newlist.append(item)
+                cart.item_list = newlist
+            cart.version = Shopcart.version + 1
             db.session.commit()
+        except PreconditionFailedError:
+            db.session.rollback()
+            raise
         except Exception as e:
             db.session.rollback()
             logger.error("Error updating record: %s", self)
             raise DataValidationError(e) from e
+        finally:
+            cart_cache.invalidate(customer_id)
 
     def delete(self):
         """Removes a Shopcart from the data store"""
-        logger.info("Deleting shopcart for customer %s", self.customer_id)
+        customer_id = self.customer_id
+        logger.info("Deleting shopcart for customer %s", customer_id)
         try:
             db.session.delete(self)
             db.session.commit()
@@ -155,23 +343,75 @@ class Shopcart(db.Model):
             db.session.rollback()
             logger.error("Error deleting record: %s", self)
             raise DataValidationError(e) from e
+        finally:
+            cart_cache.invalidate(customer_id)
 
     def delete_subordinate(self, customer_id, product_id):
         """Removes a Shopcart from the data store"""
         logger.info("Deleting shopcart for customer %s", customer_id)
         try:
             cart = self.find(customer_id)
-            newlist = []
-            for item in cart.item_list:
-                if item["product_id"] == product_id:
-                    continue
-                newlist.append(item)
-            cart.item_list = newlist
+            if item_table_enabled():
+                ShopcartItem.query.filter_by(
+                    shopcart_id=cart.id, product_id=product_id
+                ).delete()
+            else:
+                newlist = []
+                for item in cart.item_list:
+                    if item["product_id"] == product_id:
+                        continue
+                    newlist.append(item)
+                cart.item_list = newlist
+            cart.version = Shopcart.version + 1
             db.session.commit()
         except Exception as e:
             db.session.rollback()
             logger.error("Error deleting record: %s", self)
             raise DataValidationError(e) from e
+        finally:
+            cart_cache.invalidate(customer_id)
+
+    @staticmethod
+    def _upsert_item_row(customer_id, data):
+        """Returns an INSERT ... ON CONFLICT statement adding an item row to a cart"""
+        # Bumping the version of the cart in the same statement also locks it
+        cart = (
+            db.update(Shopcart)
+            .where(Shopcart.customer_id == customer_id)
+            .values(version=Shopcart.version + 1)
+            .returning(Shopcart.id)
+            .cte("cart")
+        )
+        row = select(
+            cart.c.id,
+            literal(data["product_id"]),
+            literal(data["description"]),
+            literal(data["price"]),
+            literal(data["quantity"]),
+            ShopcartItem.next_position(cart.c.id),
+        )
+        stmt = insert(ShopcartItem).from_select(
+            ["shopcart_id", "product_id", "description", "price", "quantity", "position"],
+            row,
+        )
+        return stmt.on_conflict_do_update(
+            index_elements=[ShopcartItem.shopcart_id, ShopcartItem.product_id],
+            set_={"quantity": ShopcartItem.quantity + stmt.excluded.quantity},
+        ).returning(
+            ShopcartItem.product_id,
+            ShopcartItem.description,
+            ShopcartItem.price,
+            ShopcartItem.quantity,
+        )
+
+    def _update_item_row(self, cart, data):
+        """Replaces the fields of an item row if the product is in the cart"""
+        self.validate_item_list("item_list", [data])
+        item = db.session.get(ShopcartItem, (cart.id, data["product_id"]))
+        if item:
+            item.description = data["description"]
+            item.price = data["price"]
+            item.quantity = data["quantity"]
 
     def serialize(self):
         """Serializes a Shopcart into a dictionary"""
@@ -214,6 +454,40 @@ class Shopcart(db.Model):
         logger.info("Processing all Shopcarts")
         return cls.query.all()
 
+    @classmethod
+    def find_page(cls, limit, after=None):
+        """
+        Returns a page of Shopcarts ordered by id
+
+        Args:
+            limit (int): the maximum number of Shopcarts to return
+            after (int): only Shopcarts with an id greater than this one
+
+        Seeking on the primary key keeps the cost of a page independent
+        of how far into the table it is.
+        """
+        logger.info("Processing page of %d Shopcarts after id %s", limit, after)
+        query = cls.query.order_by(cls.id)
+        if item_table_enabled():
+            query = query.options(selectinload(cls.items))
+        if after is not None:
+            query = query.filter(cls.id > after)
+        return query.limit(limit).all()
+
+    @classmethod
+    def stream(cls, batch_size=500):
+        """
+        Yields every Shopcart ordered by id
+
+        The rows are fetched batch_size at a time from a server-side cursor
+        so the whole table is never held in memory.
+        """
+        logger.info("Streaming all Shopcarts")
+        stmt = select(cls).order_by(cls.id).execution_options(yield_per=batch_size)
+        if item_table_enabled():
+            stmt = stmt.options(selectinload(cls.items))
+        yield from db.session.scalars(stmt)
+
     @classmethod
     def find(cls, by_id):
         """Finds a Shopcart by customer ID"""
@@ -221,19 +495,124 @@ class Shopcart(db.Model):
         return cls.query.filter_by(customer_id=by_id).first()
 
     @classmethod
-    def find_filtered(cls, by_id, by_price):
-        """Returns all of the items in shopcart item_list filtered by max_price"""
-        logger.info("Processing all Shopcarts")
-        cart = cls.query.filter_by(customer_id=by_id).first()
-        out = []
+    def _find_for_update(cls, by_id, if_match=None):
+        """Finds a Shopcart to change, checking its ETag against if_match"""
+        query = cls.query.filter_by(customer_id=by_id)
+        if if_match:
+            # Lock the row so the ETag cannot change before the update
+            query = query.with_for_update()
+        cart = query.first()
+        if if_match and cart is not None and cart.etag not in if_match:
+            raise PreconditionFailedError(
+                f"Shopcart for customer '{by_id}' has been changed."
+            )
+        return cart
+
+    @classmethod
+    def find_serialized(cls, by_id, if_none_match=()):
+        """
+        Finds a serialized Shopcart and its ETag by customer ID
+
+        The dictionary comes from the cart cache when it holds the cart, so
+        callers must not modify it. Returns (None, None) when there is no
+        Shopcart, and (None, etag) when the ETag is in if_none_match: the
+        caller's copy is current so the Shopcart is not loaded at all.
+        """
+        cached = cart_cache.get(by_id)
+        if cached is not None:
+            etag, data = cached
+            return (None, etag) if etag in if_none_match else (data, etag)
+
+        generation = cart_cache.generation()
+        if if_none_match:
+            row = db.session.execute(
+                select(cls.id, cls.version).where(cls.customer_id == by_id)
+            ).first()
+            if row is None:
+                return None, None
+            etag = make_etag(row.id, row.version)
+            if etag in if_none_match:
+                return None, etag
+
+        cart = cls.find(by_id)
         if cart is None:
+            return None, None
+        etag = cart.etag
+        data = cart.serialize()
+        data["item_list"] = [dict(item) for item in data["item_list"]]
+        cart_cache.set(by_id, (etag, data), generation)
+        return data, etag
+
+    @classmethod
+    def find_filtered(cls, by_id, max_price=None, min_price=None, description=None):
+        """
+        Returns the items of a Shopcart matching all of the given filters
+
+        Args:
+            by_id (int): the customer ID of the Shopcart
+            max_price (int): only items with a price at or below this value
+            min_price (int): only items with a price at or above this value
+            description (str): only items whose description contains this text,
+                ignoring case
+
+        Returns None when the customer has no Shopcart. The filtering runs in
+        the database so only the matching items are fetched.
+        """
+        logger.info("Processing filtered items for id %s ...", by_id)
+        if item_table_enabled():
+            return cls._find_filtered_rows(by_id, max_price, min_price, description)
+
+        conditions = []
+        variables = {}
+        if max_price is not None:
+            conditions.append("@.price <= $max_price")
+            variables["max_price"] = int(max_price)
+        if min_price is not None:
+            conditions.append("@.price >= $min_price")
+            variables["min_price"] = int(min_price)
+        if description is not None:
+            # like_regex only accepts a literal pattern, so quote it for both
+            # the regular expression and the JSON path string
+            pattern = re.escape(description).replace("\\", "\\\\").replace('"', '\\"')
+            conditions.append(f'@.description like_regex "{pattern}" flag "i"')
+        path = "$[*]"
+        if conditions:
+            path += " ? (" + " && ".join(conditions) + ")"
+        return db.session.execute(
+            FILTER_ITEMS_SQL,
+            {"customer_id": by_id, "path": path, "vars": json.dumps(variables)},
+        ).scalar()
+
+    @classmethod
+    def _find_filtered_rows(cls, by_id, max_price, min_price, description):
+        """Returns the filtered items of a Shopcart from the shopcart_items table"""
+        conditions = [ShopcartItem.shopcart_id == cls.id]
+        if max_price is not None:
+            conditions.append(ShopcartItem.price <= int(max_price))
+        if min_price is not None:
+            conditions.append(ShopcartItem.price >= int(min_price))
+        if description is not None:
+            conditions.append(ShopcartItem.description.icontains(description, autoescape=True))
+        # The outer join returns one row of NULLs for a cart without matches
+        # and no row at all when the cart does not exist
+        rows = db.session.execute(
+            select(
+                ShopcartItem.product_id,
+                ShopcartItem.description,
+                ShopcartItem.price,
+                ShopcartItem.quantity,
+            )
+            .select_from(cls)
+            .outerjoin(ShopcartItem, and_(*conditions))
+            .where(cls.customer_id == by_id)
+            .order_by(ShopcartItem.position)
+        ).all()
+        if not rows:
             return None
-        for item in cart.item_list:
-            if int(item["price"]) <= int(by_price):
-                out.append(item)
-        return out
+        return [row._asdict() for row in rows if row.product_id is not None]
 
     @classmethod
     def save(cls):
         """Saves the model state"""
         db.session.commit()
+        cart_cache.clear()
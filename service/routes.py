@@ -21,11 +21,16 @@ This service implements a REST API that allows you to Create, Read, Update
 and Delete Shopcart
 """
 
-from flask import jsonify, request, url_for, abort
+import base64
+import binascii
+import json
+from flask import Response, jsonify, request, url_for, abort, stream_with_context
 from flask import current_app as app  # Import Flask application
-from flask_restx import Api, Resource, fields, reqparse
+from flask_restx import Api, Resource, fields, marshal, reqparse
+from werkzeug.http import quote_etag
 from service.models import Shopcart
 from service.common import status  # HTTP Status Codes
+from service.common.cart_cache import cart_cache
 
 # API_BASEURL = "/api"  # Prefix for REST routes
 
@@ -91,6 +96,13 @@ shopcart_model = api.model(
 # Parser for query params
 parser = reqparse.RequestParser()
 parser.add_argument("max-price", type=int, location="args")
+parser.add_argument("min-price", type=int, location="args")
+parser.add_argument("description", type=str, location="args")
+
+# Parser for the pagination query params
+page_parser = reqparse.RequestParser()
+page_parser.add_argument("limit", type=int, location="args")
+page_parser.add_argument("after", type=str, location="args")
 
 
 ######################################################################
@@ -102,6 +114,15 @@ def health_check():
     return jsonify(status=200, message="OK"), status.HTTP_200_OK
 
 
+######################################################################
+# GET SERVICE STATISTICS
+######################################################################
+@app.route("/stats")
+def service_stats():
+    """Returns the statistics of this worker"""
+    return jsonify(cache=cart_cache.stats()), status.HTTP_200_OK
+
+
 ######################################################################
 #  R E S T   A P I   E N D P O I N T S
 ######################################################################
@@ -123,8 +144,9 @@ class ShopcartResource(Resource):
     # Read a SHOPCART
     # ------------------------------------------------------------------
     @api.doc("get_shopcart")
+    @api.response(200, "Success", shopcart_model)
+    @api.response(304, "Shopcart not modified")
     @api.response(404, "Shopcart not found")
-    @api.marshal_with(shopcart_model)
     def get(self, customer_id):
         """
         Retrieve a single Shopcart
@@ -135,16 +157,18 @@ class ShopcartResource(Resource):
             "Request to Retrieve a shopcart with customer id [%s]", customer_id
         )
         # Attempt to find the Shopcart and abort if not found
-        shopcart = Shopcart.find(customer_id)
+        shopcart, etag = Shopcart.find_serialized(customer_id, request.if_none_match)
 
-        if not shopcart:
+        if not etag:
             abort(
                 status.HTTP_404_NOT_FOUND,
                 f"Shopcart for customer '{customer_id}' was not found.",
             )
+        if shopcart is None:
+            return "", status.HTTP_304_NOT_MODIFIED, etag_header(etag)
 
-        app.logger.info("Returning shopcart: %s", shopcart.customer_id)
-        return shopcart.serialize(), status.HTTP_200_OK
+        app.logger.info("Returning shopcart: %s", shopcart["customer_id"])
+        return marshal(shopcart, shopcart_model), status.HTTP_200_OK, etag_header(etag)
 
     # ------------------------------------------------------------------
     # Delete a SHOPCART
@@ -176,6 +200,7 @@ class ShopcartResource(Resource):
     @api.doc("update_shopcart")
     @api.response(404, "Shopcart not found")
     @api.response(400, "The Shopcart data was not valid")
+    @api.response(412, "The Shopcart does not match If-Match")
     @api.response(200, "Shopcart updated")
     @api.expect([item_model])
     @api.marshal_with(shopcart_model, code=200)
@@ -201,10 +226,10 @@ class ShopcartResource(Resource):
         app.logger.info("Processing: %s", data)
 
         # Save the updates to the database
-        shopcart.update(customer_id, data)
+        shopcart.update(customer_id, data, if_match=request.if_match)
 
         app.logger.info("Shopcart for customer %d updated.", customer_id)
-        return shopcart.serialize(), status.HTTP_200_OK
+        return shopcart.serialize(), status.HTTP_200_OK, etag_header(shopcart.etag)
 
 
 ######################################################################
@@ -261,20 +286,75 @@ class ShopcartCollection(Resource):
     # LIST ALL SHOPCARTS
     # ------------------------------------------------------------------
     @api.doc("list_shopcarts")
-    @api.marshal_list_with(shopcart_model)
+    @api.doc(
+        params={
+            "limit": "Maximum number of shopcarts to return",
+            "after": "Cursor from the Link header of the previous page",
+        }
+    )
+    @api.expect(page_parser)
+    @api.doc(produces=["application/json", "application/x-ndjson"])
+    @api.response(200, "Success", [shopcart_model])
+    @api.response(400, "The pagination query string was not valid")
     @api.response(404, "Shopcarts not found")
     def get(self):
-        """List all shopcarts"""
+        """
+        List all shopcarts
+
+        The shopcarts are returned one page at a time. When there are more,
+        the Link header holds the URL of the next page.
+
+        With Accept: application/x-ndjson every shopcart is streamed instead,
+        one JSON document per line.
+        """
 
         app.logger.info("Request to Retrieve all shopcarts")
+        if (
+            request.accept_mimetypes.best_match(
+                ["application/json", "application/x-ndjson"]
+            )
+            == "application/x-ndjson"
+        ):
+            return stream_shopcarts()
+
+        limit = request.args.get("limit", app.config["PAGE_SIZE"])
+        try:
+            limit = int(limit)
+        except ValueError:
+            abort(
+                status.HTTP_400_BAD_REQUEST,
+                "Query string 'limit' must be of type: Integer",
+            )
+        if not 0 < limit <= app.config["MAX_PAGE_SIZE"]:
+            abort(
+                status.HTTP_400_BAD_REQUEST,
+                f"Query string 'limit' must be between 1 and {app.config['MAX_PAGE_SIZE']}",
+            )
+        after = request.args.get("after")
+        if after is not None:
+            after = decode_cursor(after)
 
-        # Attempt to find the Shopcart and abort if not found
-        shopcart = Shopcart.all()
+        # Fetch one extra Shopcart to know whether there is a next page
+        shopcart = Shopcart.find_page(limit + 1, after)
         if not shopcart:
             return [], status.HTTP_200_OK
 
-        app.logger.info("Returning shopcarts: %s", shopcart)
-        return [x.serialize() for x in shopcart], status.HTTP_200_OK
+        headers = {}
+        if len(shopcart) > limit:
+            shopcart = shopcart[:limit]
+            cursor = encode_cursor(shopcart[-1].id)
+            next_url = url_for(
+                "shopcart_collection", limit=limit, after=cursor, _external=True
+            )
+            headers["Link"] = f'<{next_url}>; rel="next"'
+            headers["X-Next-Cursor"] = cursor
+
+        app.logger.info("Returning %d shopcarts", len(shopcart))
+        return (
+            marshal([x.serialize() for x in shopcart], shopcart_model),
+            status.HTTP_200_OK,
+            headers,
+        )
 
 
 ######################################################################
@@ -338,7 +418,8 @@ class ShopcartItemResource(Resource):
     # READ AN INDIVIDUAL ITEM FROM SHOPCART
     # ------------------------------------------------------------------
     @api.doc("get_item")
-    @api.marshal_with(item_model)
+    @api.response(200, "Success", item_model)
+    @api.response(304, "Shopcart not modified")
     @api.response(404, "Shopcart Item not found")
     def get(self, customer_id, product_id):
         """
@@ -351,17 +432,19 @@ class ShopcartItemResource(Resource):
         )
 
         # Attempt to find the Shopcart and abort if not found
-        shopcart = Shopcart.find(customer_id)
-        if not shopcart:
+        shopcart, etag = Shopcart.find_serialized(customer_id, request.if_none_match)
+        if not etag:
             abort(
                 status.HTTP_404_NOT_FOUND,
                 f"Shopcart for customer '{customer_id}' was not found.",
             )
-        item_list = shopcart.item_list
+        if shopcart is None:
+            return "", status.HTTP_304_NOT_MODIFIED, etag_header(etag)
+        item_list = shopcart["item_list"]
         for item in item_list:
             if item["product_id"] == product_id:
-                app.logger.info("Returning shopcart: %s", shopcart.customer_id)
-                return item, status.HTTP_200_OK
+                app.logger.info("Returning shopcart: %s", shopcart["customer_id"])
+                return marshal(item, item_model), status.HTTP_200_OK, etag_header(etag)
 
         abort(
             status.HTTP_404_NOT_FOUND,
@@ -377,6 +460,7 @@ class ShopcartItemResource(Resource):
     @api.response(404, "Shopcart Item not found")
     @api.response(200, "Shopcart  Item updated")
     @api.response(400, "The Shopcart Item data was not valid")
+    @api.response(412, "The Shopcart does not match If-Match")
     def put(self, customer_id, product_id):
         """
         Update a Shopcart
@@ -403,10 +487,10 @@ class ShopcartItemResource(Resource):
         app.logger.info("Processing: %s", data)
 
         # Save the updates to the database
-        shopcart.update_subordinate(customer_id, data)
+        shopcart.update_subordinate(customer_id, data, if_match=request.if_match)
 
         app.logger.info("Shopcart for customer %d updated.", customer_id)
-        return shopcart.serialize(), status.HTTP_200_OK
+        return shopcart.serialize(), status.HTTP_200_OK, etag_header(shopcart.etag)
 
     # ------------------------------------------------------------------
     # DELETE AN ITEM FROM SHOPCART
@@ -456,10 +540,13 @@ class ShopcartItemCollection(Resource):
     @api.doc(
         params={
             "max-price": "Maximum price of item to filter by",
+            "min-price": "Minimum price of item to filter by",
+            "description": "Text the item description must contain",
         }
     )
     @api.expect(parser)
-    @api.marshal_list_with(item_model)
+    @api.response(200, "Success", [item_model])
+    @api.response(304, "Shopcart not modified")
     @api.response(400, "The query string was of incorrect type")
     @api.response(404, "The customer had no shopcart associated")
     def get(self, customer_id):
@@ -469,32 +556,42 @@ class ShopcartItemCollection(Resource):
         This endpoint will return all entries in the database
         """
         app.logger.info("Request to Retrieve all shopcart items for customer")
-        max_price = request.args.get("max-price")
+        filters = {}
+        try:
+            for arg, name in (("max-price", "max_price"), ("min-price", "min_price")):
+                if request.args.get(arg):
+                    filters[name] = int(request.args.get(arg))
+        except ValueError:
+            abort(
+                status.HTTP_400_BAD_REQUEST,
+                "Query string must be of type: Integer",
+            )
+        if request.args.get("description"):
+            filters["description"] = request.args.get("description")
 
         # Attempt to find the Shopcart and abort if not found
-        if max_price:
-            try:
-                max_price = int(max_price)
-                shopcart = Shopcart.find_filtered(customer_id, max_price)
-            except ValueError:
-                abort(
-                    status.HTTP_400_BAD_REQUEST,
-                    "Query string must be of type: Integer",
-                )
+        headers = {}
+        if filters:
+            shopcart = Shopcart.find_filtered(customer_id, **filters)
         else:
-            try:
-                shopcart = Shopcart.find(customer_id).item_list
-            except AttributeError:
+            shopcart, etag = Shopcart.find_serialized(
+                customer_id, request.if_none_match
+            )
+            if not etag:
                 abort(
                     status.HTTP_404_NOT_FOUND,
                     "Shopcart not found",
                 )
+            headers = etag_header(etag)
+            if shopcart is None:
+                return "", status.HTTP_304_NOT_MODIFIED, headers
+            shopcart = shopcart["item_list"]
 
         if not shopcart:
-            return [], status.HTTP_200_OK
+            return [], status.HTTP_200_OK, headers
 
         app.logger.info("Returning shopcart items: %s", shopcart)
-        return shopcart, status.HTTP_200_OK
+        return marshal(shopcart, item_model), status.HTTP_200_OK, headers
 
     # ------------------------------------------------------------------
     # CREATE A NEW ITEM IN SHOPCART
@@ -517,7 +614,7 @@ class ShopcartItemCollection(Resource):
         app.logger.info("Processing: %s", data)
 
         # Save the new Shopcart to the database
-        shopcart.create_subordinate(customer_id, data)
+        item = shopcart.create_subordinate(customer_id, data)
         app.logger.info("Shopcart item with new id saved!")
 
         # Return the location of the new Shopcart
@@ -525,11 +622,11 @@ class ShopcartItemCollection(Resource):
         location_url = url_for(
             "shopcart_item_resource",
             customer_id=customer_id,
-            product_id=data["product_id"],
+            product_id=item["product_id"],
             _external=True,
         )
         return (
-            data,
+            item,
             status.HTTP_201_CREATED,
             {"Location": location_url},
         )
@@ -540,6 +637,57 @@ class ShopcartItemCollection(Resource):
 ######################################################################
 
 
+######################################################################
+# Streams every Shopcart as newline delimited JSON
+######################################################################
+def stream_shopcarts() -> Response:
+    """Returns a response streaming one Shopcart per line"""
+    batch_size = app.config["STREAM_BATCH_SIZE"]
+
+    def generate():
+        count = 0
+        for shopcart in Shopcart.stream(batch_size):
+            count += 1
+            yield json.dumps(shopcart.serialize()) + "\n"
+        app.logger.info("Streamed %d shopcarts", count)
+
+    return Response(
+        stream_with_context(generate()), mimetype="application/x-ndjson"
+    )
+
+
+######################################################################
+# Encodes and decodes the opaque pagination cursors
+######################################################################
+def encode_cursor(shopcart_id) -> str:
+    """Returns the cursor for the page after the Shopcart with this id"""
+    data = json.dumps({"id": shopcart_id}).encode("utf-8")
+    return base64.urlsafe_b64encode(data).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor) -> int:
+    """Returns the Shopcart id a cursor points after"""
+    try:
+        data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        shopcart_id = json.loads(data)["id"]
+    except (binascii.Error, ValueError, KeyError, TypeError):
+        shopcart_id = None
+    if not isinstance(shopcart_id, int) or isinstance(shopcart_id, bool):
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            "Query string 'after' is not a valid cursor",
+        )
+    return shopcart_id
+
+
+######################################################################
+# Returns the header sending the ETag of a Shopcart
+######################################################################
+def etag_header(etag) -> dict:
+    """Returns the ETag header for a Shopcart ETag"""
+    return {"ETag": quote_etag(etag)}
+
+
 ######################################################################
 # Checks the ContentType of a request
 ######################################################################
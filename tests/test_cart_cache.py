@@ -0,0 +1,86 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the Cart Cache
+"""
+
+from unittest import TestCase
+from unittest.mock import patch
+from service.common.cart_cache import CartCache
+
+
+######################################################################
+#  C A R T   C A C H E   T E S T   C A S E S
+######################################################################
+class TestCartCache(TestCase):
+    """Test Cases for CartCache"""
+
+    def test_disabled(self):
+        """It should not cache anything when the size is 0"""
+        cache = CartCache(max_size=0)
+        cache.set(1, {"customer_id": 1}, cache.generation())
+        self.assertIsNone(cache.get(1))
+        self.assertFalse(cache.stats()["enabled"])
+        self.assertEqual(cache.stats()["misses"], 0)
+
+    def test_hit_and_miss(self):
+        """It should count hits and misses"""
+        cache = CartCache(max_size=2)
+        self.assertIsNone(cache.get(1))
+        cache.set(1, {"customer_id": 1}, cache.generation())
+        self.assertEqual(cache.get(1), {"customer_id": 1})
+        stats = cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["hit_rate"], 0.5)
+        self.assertEqual(stats["miss_rate"], 0.5)
+        self.assertEqual(stats["size"], 1)
+
+    def test_evict_least_recently_used(self):
+        """It should evict the least recently used entry when full"""
+        cache = CartCache(max_size=2)
+        cache.set(1, "one", cache.generation())
+        cache.set(2, "two", cache.generation())
+        cache.get(1)
+        cache.set(3, "three", cache.generation())
+        self.assertEqual(cache.get(1), "one")
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(cache.get(3), "three")
+
+    def test_expire(self):
+        """It should not return entries older than the ttl"""
+        cache = CartCache(max_size=2, ttl=10)
+        with patch("service.common.cart_cache.time.monotonic", return_value=100.0):
+            cache.set(1, "one", cache.generation())
+        with patch("service.common.cart_cache.time.monotonic", return_value=105.0):
+            self.assertEqual(cache.get(1), "one")
+        with patch("service.common.cart_cache.time.monotonic", return_value=111.0):
+            self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.stats()["size"], 0)
+
+    def test_invalidate(self):
+        """It should drop invalidated entries and values read before the invalidation"""
+        cache = CartCache(max_size=2)
+        cache.set(1, "one", cache.generation())
+        generation = cache.generation()
+        cache.invalidate(1)
+        self.assertIsNone(cache.get(1))
+        cache.set(1, "stale", generation)
+        self.assertIsNone(cache.get(1))
+        cache.set(2, "two", cache.generation())
+        cache.clear()
+        self.assertIsNone(cache.get(2))
@@ -21,9 +21,10 @@ Test cases for Shopcart Model
 # pylint: disable=duplicate-code
 import os
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from unittest import TestCase
 from wsgi import app
-from service.models import Shopcart, DataValidationError, db
+from service.models import Shopcart, ShopcartItem, DataValidationError, db
 from .factories import ShopcartFactory
 
 DATABASE_URI = os.getenv(
@@ -94,6 +95,43 @@ class TestShopcart(TestCase):
         }
         resource.create_subordinate(resource.customer_id, new_item)
 
+    def test_create_item_increments_quantity(self):
+        """It should return the item with the added quantity of an existing product"""
+        resource = ShopcartFactory()
+        resource.create()
+        new_item = {"product_id": 1, "description": "Banana", "price": 100, "quantity": 2}
+        item = resource.create_subordinate(resource.customer_id, dict(new_item))
+        self.assertEqual(item, new_item)
+        item = resource.create_subordinate(resource.customer_id, dict(new_item))
+        self.assertEqual(item["quantity"], 4)
+        found = Shopcart.find(resource.customer_id)
+        self.assertEqual(found.item_list, [dict(new_item, quantity=4)])
+
+    def test_create_item_concurrently(self):
+        """It should not lose quantity when the same product is added concurrently"""
+        resource = ShopcartFactory()
+        resource.create()
+        customer_id = resource.customer_id
+        new_item = {"product_id": 1, "description": "Banana", "price": 100, "quantity": 1}
+
+        def add_item(_):
+            with app.app_context():
+                Shopcart().create_subordinate(customer_id, dict(new_item))
+                db.session.remove()
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(add_item, range(20)))
+        db.session.expire_all()
+        found = Shopcart.find(customer_id)
+        self.assertEqual(found.item_list[0]["quantity"], 20)
+
+    def test_create_item_no_shopcart(self):
+        """It should raise a DataValidationError when adding an item to a nonexistent cart"""
+        new_item = {"product_id": 1, "description": "Banana", "price": 100, "quantity": 2}
+        self.assertRaises(
+            DataValidationError, Shopcart().create_subordinate, 9999, new_item
+        )
+
     def test_delete(self):
         """It should delete created shopcart"""
         resource = ShopcartFactory()
@@ -319,6 +357,31 @@ class TestShopcart(TestCase):
         result = Shopcart.find_filtered(99999, 100)
         self.assertIsNone(result)
 
+    def test_find_filtered(self):
+        """It should return only the items matching the filters"""
+        shopcart = ShopcartFactory()
+        shopcart.create()
+        shopcart.item_list = [
+            {"product_id": 1, "description": "Red apple", "price": 10, "quantity": 2},
+            {"product_id": 2, "description": "Banana", "price": 20, "quantity": 1},
+            {"product_id": 3, "description": 'Apple "pie" 1.5', "price": 30, "quantity": 1},
+        ]
+        db.session.commit()
+        customer_id = shopcart.customer_id
+        found = Shopcart.find_filtered(customer_id, 20)
+        self.assertEqual([item["product_id"] for item in found], [1, 2])
+        found = Shopcart.find_filtered(customer_id, min_price=20)
+        self.assertEqual([item["product_id"] for item in found], [2, 3])
+        found = Shopcart.find_filtered(customer_id, max_price=25, min_price=15)
+        self.assertEqual([item["product_id"] for item in found], [2])
+        found = Shopcart.find_filtered(customer_id, description="APPLE")
+        self.assertEqual([item["product_id"] for item in found], [1, 3])
+        found = Shopcart.find_filtered(customer_id, description='"pie" 1.5')
+        self.assertEqual(found, [shopcart.item_list[2]])
+        self.assertEqual(Shopcart.find_filtered(customer_id, description="1_5"), [])
+        self.assertEqual(Shopcart.find_filtered(customer_id, max_price=5), [])
+        self.assertEqual(Shopcart.find_filtered(customer_id), shopcart.item_list)
+
     def test_create_database_error(self):
         """It should handle database errors during create"""
         shopcart = ShopcartFactory()
@@ -333,3 +396,74 @@ class TestShopcart(TestCase):
         except (ValueError, TypeError, AttributeError) as e:
             # This is also acceptable as it tests the exception handling
             self.assertIsInstance(e, (ValueError, TypeError, AttributeError))
+
+
+######################################################################
+#  Shopcart   M O D E L   T E S T S   W I T H   I T E M   T A B L E
+######################################################################
+
+
+class TestShopcartItemTable(TestShopcart):
+    """Runs the Shopcart Model tests with items in the shopcart_items table"""
+
+    @classmethod
+    def setUpClass(cls):
+        """This runs once before the entire test suite"""
+        super().setUpClass()
+        app.config["ITEM_STORAGE"] = "table"
+
+    @classmethod
+    def tearDownClass(cls):
+        """This runs once after the entire test suite"""
+        app.config["ITEM_STORAGE"] = "jsonb"
+        super().tearDownClass()
+
+    def test_item_rows(self):
+        """It should store one shopcart_items row per item"""
+        shopcart = ShopcartFactory()
+        shopcart.create()
+        new_item = {"product_id": 1, "description": "Banana", "price": 100, "quantity": 2}
+        shopcart.create_subordinate(shopcart.customer_id, dict(new_item))
+        shopcart.create_subordinate(shopcart.customer_id, dict(new_item, product_id=2))
+        shopcart.create_subordinate(shopcart.customer_id, dict(new_item))
+        rows = ShopcartItem.query.filter_by(shopcart_id=shopcart.id).all()
+        self.assertEqual(len(rows), 2)
+        found = Shopcart.find(shopcart.customer_id)
+        self.assertEqual(found.item_list[0], dict(new_item, quantity=4))
+        self.assertEqual(found.item_list[1]["product_id"], 2)
+        self.assertEqual(found._item_list, [])
+
+    def test_update_item_row(self):
+        """It should update only the matching shopcart_items row"""
+        shopcart = ShopcartFactory()
+        shopcart.create()
+        shopcart.item_list = [
+            {"product_id": 1, "description": "apple", "price": 10, "quantity": 2},
+            {"product_id": 2, "description": "banana", "price": 20, "quantity": 1},
+        ]
+        db.session.commit()
+        shopcart.update_subordinate(
+            shopcart.customer_id,
+            {"product_id": 2, "description": "banana", "price": 25, "quantity": 7},
+        )
+        shopcart.update_subordinate(
+            shopcart.customer_id,
+            {"product_id": 3, "description": "cherry", "price": 5, "quantity": 1},
+        )
+        found = Shopcart.find(shopcart.customer_id)
+        self.assertEqual(len(found.item_list), 2)
+        self.assertEqual(found.item_list[1]["price"], 25)
+        self.assertEqual(found.item_list[1]["quantity"], 7)
+
+    def test_replace_item_rows_keeps_order(self):
+        """It should keep the order of a replaced item_list"""
+        shopcart = ShopcartFactory()
+        shopcart.create()
+        apple = {"product_id": 1, "description": "apple", "price": 10, "quantity": 2}
+        banana = {"product_id": 2, "description": "banana", "price": 20, "quantity": 1}
+        shopcart.update(shopcart.customer_id, [apple, banana])
+        shopcart.update(shopcart.customer_id, [banana, apple])
+        found = Shopcart.find(shopcart.customer_id)
+        self.assertEqual(found.serialize()["item_list"], [banana, apple])
+        shopcart.update(shopcart.customer_id, [apple])
+        self.assertEqual(ShopcartItem.query.count(), 1)
@@ -20,11 +20,13 @@ TestShopcart API Service Test Suite
 
 # pylint: disable=duplicate-code
 import os
+import json
 import logging
 from unittest import TestCase
 from wsgi import app
 from service.common import status
 from service.models import db, Shopcart
+from service.common.cart_cache import cart_cache
 from .factories import ShopcartFactory
 
 DATABASE_URI = os.getenv(
@@ -203,6 +205,30 @@ class TestShopcartService(TestCase):
         data = response.get_json()
         self.assertEqual(data["customer_id"], test_shopcart.customer_id)
 
+    def test_get_shopcart_cached(self):
+        """It should Get a Shopcart from the cart cache until it is changed"""
+        test_shopcart = self._create_shopcarts(1)[0]
+        customer_id = test_shopcart.customer_id
+        cart_cache.max_size = 10
+        try:
+            response = self.client.get(f"{BASE_URL}/{customer_id}")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            response = self.client.get(f"{BASE_URL}/{customer_id}/items")
+            self.assertEqual(response.get_json(), [])
+            new_item = {"product_id": 1, "description": "Banana", "price": 100, "quantity": 2}
+            self.client.post(f"{BASE_URL}/{customer_id}/items", json=new_item)
+            response = self.client.get(f"{BASE_URL}/{customer_id}/items/1")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            response = self.client.get(f"{BASE_URL}/{customer_id}")
+            self.assertEqual(response.get_json()["item_list"], [new_item])
+            response = self.client.get("/stats")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            stats = response.get_json()["cache"]
+            self.assertEqual(stats["hits"], 2)
+            self.assertEqual(stats["misses"], 2)
+        finally:
+            cart_cache.init_app(app)
+
     def test_get_shopcart_not_found(self):
         """It should not Get a Shopcart thats not found"""
         response = self.client.get(f"{BASE_URL}/0")
@@ -266,6 +292,38 @@ class TestShopcartService(TestCase):
         data = response.get_json()
         self.assertEqual(data, set_carts)
 
+    def test_get_all_shopcart_pages(self):
+        """It should Get all Shopcarts one page at a time"""
+        set_carts = [i.serialize() for i in self._create_shopcarts(5)]
+        response = self.client.get(f"{BASE_URL}?limit=2")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        pages = [response.get_json()]
+        while "Link" in response.headers:
+            self.assertIn('rel="next"', response.headers["Link"])
+            cursor = response.headers["X-Next-Cursor"]
+            response = self.client.get(f"{BASE_URL}?limit=2&after={cursor}")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            pages.append(response.get_json())
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        self.assertEqual([cart for page in pages for cart in page], set_carts)
+
+    def test_stream_all_shopcart(self):
+        """It should stream all Shopcarts as NDJSON"""
+        set_carts = [i.serialize() for i in self._create_shopcarts(3)]
+        response = self.client.get(
+            f"{BASE_URL}?limit=1", headers={"Accept": "application/x-ndjson"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual([json.loads(line) for line in lines], set_carts)
+
+    def test_get_all_shopcart_bad_page(self):
+        """It should not Get Shopcarts with a bad limit or cursor"""
+        for query in ("limit=0", "limit=x", "limit=100000", "after=x", "after=eyJpZCI6ICJ4In0"):
+            response = self.client.get(f"{BASE_URL}?{query}")
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, query)
+
     def test_get_all_shopcart_not_found(self):
         """It should empty list for no shopcarts"""
         response = self.client.get(f"{BASE_URL}")
@@ -318,6 +376,28 @@ class TestShopcartService(TestCase):
         filtered_shopcart = response.get_json()
         self.assertEqual(filtered_shopcart, test_list)
 
+    def test_get_all_shopcart_items_query_min_price_and_description(self):
+        """It should Get all items in item list matching min-price and description"""
+        test_cart = self._create_shopcarts(1)[0]
+        new_list = [
+            {"product_id": 1, "description": "Item 1", "price": 200, "quantity": 2},
+            {"product_id": 2, "description": "Item 2", "price": 240, "quantity": 5},
+            {"product_id": 3, "description": "Gift 3", "price": 320, "quantity": 6},
+        ]
+        response = self.client.put(f"{BASE_URL}/{test_cart.customer_id}", json=new_list)
+        response = self.client.get(
+            f"{BASE_URL}/{test_cart.customer_id}/items?min-price=220"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json(), new_list[1:])
+        response = self.client.get(
+            f"{BASE_URL}/{test_cart.customer_id}/items?min-price=220&description=item"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json(), [new_list[1]])
+        response = self.client.get(f"{BASE_URL}/{test_cart.customer_id}/items?min-price=x")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_get_all_shopcart_items_query_max_price_not_found(self):
         """It should not get any items if none meet the max price criteria"""
         test_cart = self._create_shopcarts(1)[0]
@@ -609,3 +689,22 @@ class TestShopcartService(TestCase):
         # Try to get items from a shopcart that doesn't exist
         response = self.client.get(f"{BASE_URL}/999/items")
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+######################################################################
+#  T E S T   C A S E S   W I T H   I T E M   T A B L E
+######################################################################
+class TestShopcartServiceItemTable(TestShopcartService):
+    """REST API Server Tests with items in the shopcart_items table"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Run once before all tests"""
+        super().setUpClass()
+        app.config["ITEM_STORAGE"] = "table"
+
+    @classmethod
+    def tearDownClass(cls):
+        """Run once after all tests"""
+        app.config["ITEM_STORAGE"] = "jsonb"
+        super().tearDownClass()